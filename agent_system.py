@@ -1,13 +1,23 @@
 # agent_system.py - Simple agent for query decomposition and synthesis
 import re
-from typing import List, Dict, Any
+from itertools import islice
+from typing import List, Dict, Any, NamedTuple, Set, Tuple
 from rag_pipeline import SimpleRAGPipeline
 from utils import format_financial_response, create_source_reference, logger
 
+class SourceRef(NamedTuple):
+    """Lightweight reference to a retrieved chunk, used to build response sources."""
+    key: str
+    company: str
+    year: int
+    section: str
+    preview: str
+
 class SimpleFinancialAgent:
     def __init__(self):
-        self.rag = SimpleRAGPipeline()
-        self.rag.build_embeddings()
+        # Shared across agents in this process; the memory-mapped FAISS index
+        # is shared across processes through the OS page cache
+        self.rag = SimpleRAGPipeline.get_instance()
         
         # Simple patterns for query classification
         self.comparative_patterns = [
@@ -24,29 +34,44 @@ class SimpleFinancialAgent:
             r'from.*\d{4}.*to.*\d{4}',
             r'growth.*\d{4}.*\d{4}'
         ]
+        
+        # Pre-compile patterns once so per-query matching skips the re cache lookup.
+        # Each pattern list is fused into a single alternation so classification
+        # is one scan per query type instead of one scan per pattern.
+        self._comparative_re = re.compile("|".join(f"(?:{p})" for p in self.comparative_patterns))
+        self._multi_year_re = re.compile("|".join(f"(?:{p})" for p in self.multi_year_patterns))
+        self._year_re = re.compile(r'\b(20\d{2})\b')
+        self._from_to_re = re.compile(r'from.*to.*\d{4}')
+        self._yr_to_yr_re = re.compile(r'\d{4}.*to.*\d{4}')
+        # A '.'-delimited sentence containing a financial figure or keyword
+        self._fin_sentence_re = re.compile(
+            r'(?:^|(?<=\.))([^.]*?(?:\$[\d,]+|\d+%|revenue|income|margin)[^.]*)',
+            re.IGNORECASE
+        )
     
     def classify_query(self, query: str) -> str:
         """Classify query type for decomposition strategy."""
         query_lower = query.lower()
         
-        # Check for comparative queries
-        for pattern in self.comparative_patterns:
-            if re.search(pattern, query_lower):
-                return "comparative"
+        # Check for comparative queries first - they take precedence
+        if self._comparative_re.search(query_lower):
+            return "comparative"
         
         # Check for multi-year queries
-        for pattern in self.multi_year_patterns:
-            if re.search(pattern, query_lower):
-                return "multi_year"
+        if self._multi_year_re.search(query_lower):
+            return "multi_year"
         
         return "simple"
     
-    def decompose_query(self, query: str) -> List[str]:
-        """Decompose complex queries into simpler sub-queries."""
+    def decompose_query(self, query: str) -> Tuple[str, List[str]]:
+        """Decompose complex queries into simpler sub-queries.
+        
+        Returns the query type alongside the sub-queries so callers don't re-classify.
+        """
         query_type = self.classify_query(query)
         
         if query_type == "simple":
-            return [query]
+            return query_type, [query]
         
         elif query_type == "comparative":
             # For comparative queries, create sub-queries for each company
@@ -61,39 +86,49 @@ class SimpleFinancialAgent:
                 modified_query = modified_query.replace("companies", company)
                 sub_queries.append(modified_query)
             
-            return sub_queries
+            return query_type, sub_queries
         
         elif query_type == "multi_year":
             # For multi-year queries, create sub-queries for each year
-            years = re.findall(r'\b(20\d{2})\b', query)
+            years = self._year_re.findall(query)
             if len(years) >= 2:
                 sub_queries = []
                 for year in years:
-                    year_query = re.sub(r'from.*to.*\d{4}', f'in {year}', query)
-                    year_query = re.sub(r'\d{4}.*to.*\d{4}', year, year_query)
+                    year_query = self._from_to_re.sub(f'in {year}', query)
+                    year_query = self._yr_to_yr_re.sub(year, year_query)
                     sub_queries.append(year_query)
-                return sub_queries
+                return query_type, sub_queries
         
-        return [query]  # Fallback
+        return query_type, [query]  # Fallback
     
     def search_and_extract_info(self, query: str) -> Dict[str, Any]:
         """Search for information and extract key details."""
-        results = self.rag.search(query, top_k=3)
-        
-        if not results:
+        hits = self.rag.search_ids(query, top_k=3)
+        return self.extract_info(query, hits)
+    
+    def extract_info(self, query: str, hits: List[Tuple[int, float]]) -> Dict[str, Any]:
+        """Extract key details from already-retrieved (chunk index, score) hits."""
+        if not hits:
             return {"found": False, "answer": "No relevant information found"}
         
+        # Only the top 2 chunks are used - look them up without copying
+        top_chunks = [self.rag.chunks[idx] for idx, _ in hits[:2]]
+        
         # Combine top results
-        combined_text = " ".join([r['text'] for r in results[:2]])
+        combined_text = " ".join([chunk['text'] for chunk in top_chunks])
         
         # Simple information extraction
-        answer = self._extract_answer(query, combined_text, results)
+        answer = self._extract_answer(query, combined_text, top_chunks)
         
         return {
             "found": True,
             "answer": answer,
-            "results": results,
-            "source_chunks": len(results)
+            "sources": [
+                SourceRef(chunk['source_key'], chunk['company'], chunk['year'],
+                          chunk['section'], chunk['text_preview'])
+                for chunk in top_chunks
+            ],
+            "source_chunks": len(hits)
         }
     
     def _extract_answer(self, query: str, text: str, results: List[Dict]) -> str:
@@ -101,43 +136,40 @@ class SimpleFinancialAgent:
         # For this simple implementation, just return the most relevant chunk
         if results:
             best_chunk = results[0]
-            # Try to find sentences that might contain the answer
-            sentences = text.split('.')
-            
-            # Look for sentences with numbers (likely contain financial data)
-            financial_sentences = []
-            for sentence in sentences:
-                if re.search(r'\$[\d,]+|[\d.]+%|revenue|income|margin', sentence, re.IGNORECASE):
-                    financial_sentences.append(sentence.strip())
+            # Look for the first sentences with numbers (likely contain financial data)
+            matches = islice(self._fin_sentence_re.finditer(text), 2)
+            financial_sentences = [match.group(1).strip() for match in matches]
             
             if financial_sentences:
-                return '. '.join(financial_sentences[:2]) + '.'
+                return '. '.join(financial_sentences) + '.'
             else:
                 # Fallback to first chunk
                 return best_chunk['text'][:300] + "..."
         
         return "Information not found in the available documents."
     
-    def synthesize_results(self, query: str, sub_results: List[Dict]) -> str:
+    def synthesize_results(self, query_type: str, query: str, sub_results: List[Dict]) -> str:
         """Synthesize results from multiple sub-queries."""
         if len(sub_results) == 1:
             return sub_results[0]['answer']
         
+        query_lower = query.lower()
+        
         # For comparative queries, try to synthesize
-        if self.classify_query(query) == "comparative":
+        if query_type == "comparative":
             synthesis = "Based on the filings analysis:\n\n"
             for i, result in enumerate(sub_results):
                 if result['found']:
                     synthesis += f"• {result['answer']}\n"
             
             # Try to determine winner for "which company" questions
-            if "which company" in query.lower() and "highest" in query.lower():
+            if "which company" in query_lower and "highest" in query_lower:
                 synthesis += "\nBased on the available data, specific comparison requires detailed financial analysis."
             
             return synthesis
         
         # For multi-year queries
-        elif "growth" in query.lower():
+        elif "growth" in query_lower:
             return f"Growth analysis: {sub_results[0]['answer']} compared to {sub_results[1]['answer']}"
         
         # Default synthesis
@@ -147,40 +179,36 @@ class SimpleFinancialAgent:
         """Main method to answer any query with agent capabilities."""
         logger.info(f"Processing query: {query}")
         
-        # Decompose query
-        sub_queries = self.decompose_query(query)
+        # Decompose query, dropping duplicate sub-queries (order preserved)
+        query_type, sub_queries = self.decompose_query(query)
+        sub_queries = list(dict.fromkeys(sub_queries))
         logger.info(f"Decomposed into {len(sub_queries)} sub-queries")
         
-        # Process each sub-query
+        # Retrieve for all sub-queries in one batch, then extract per sub-query
         sub_results = []
-        for sub_query in sub_queries:
-            result = self.search_and_extract_info(sub_query)
+        batch_hits = self.rag.batch_search_ids(sub_queries, top_k=3)
+        for sub_query, hits in zip(sub_queries, batch_hits):
+            result = self.extract_info(sub_query, hits)
             sub_results.append(result)
         
         # Synthesize answer
-        final_answer = self.synthesize_results(query, sub_results)
+        final_answer = self.synthesize_results(query_type, query, sub_results)
         
-        # Create sources from all results
-        all_sources = []
+        # Create unique sources from all results, keyed by company/year/section
+        unique_sources = []
+        seen_sources: Set[str] = set()
         for result in sub_results:
             if result['found']:
-                for chunk in result['results'][:2]:  # Top 2 per sub-query
-                    source = create_source_reference(
-                        chunk['company'],
-                        chunk['year'],
-                        chunk['text'][:200],
-                        section=chunk['section']
-                    )
-                    all_sources.append(source)
-        
-        # Remove duplicate sources
-        unique_sources = []
-        seen_sources = set()
-        for source in all_sources:
-            key = (source['company'], source['year'], source['section'])
-            if key not in seen_sources:
-                unique_sources.append(source)
-                seen_sources.add(key)
+                for ref in result['sources']:  # Top 2 per sub-query
+                    if ref.key in seen_sources:
+                        continue
+                    seen_sources.add(ref.key)
+                    unique_sources.append(create_source_reference(
+                        ref.company,
+                        ref.year,
+                        ref.preview,
+                        section=ref.section
+                    ))
         
         # Create reasoning
         reasoning = f"Processed {len(sub_queries)} sub-queries and retrieved information from {len(unique_sources)} sources across the filings."
@@ -38,15 +38,24 @@ YEARS: List[int] = [2022, 2023, 2024]
 # SEC-API configuration
 SEC_API_KEY = os.getenv('SEC_API_KEY')
 SEC_API_BASE_URL = "https://api.sec-api.io"
+SEC_API_MAX_CONCURRENCY = 5  # Max in-flight SEC-API requests
+
+# Persistent cache of SEC-API filing URLs and extracted sections
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+FILING_URL_CACHE_TTL = 7 * 24 * 3600  # seconds
+SECTION_CACHE_TTL = 30 * 24 * 3600  # seconds
 
 # RAG Configuration
 CHUNK_SIZE = 500  # Number of words per chunk
 CHUNK_OVERLAP = 50  # Word overlap between chunks
 MAX_CHUNKS_PER_QUERY = 10  # Maximum chunks to retrieve per query
+QUERY_CACHE_SIZE = 1024  # Max cached query embeddings / search results (LRU)
+QUERY_CACHE_FLUSH_EVERY = 64  # Newly encoded queries between query-cache writes (also flushed at exit)
 
 # Embedding configuration
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"  # Fast, good quality model
 EMBEDDING_DIMENSION = 384  # Dimension for all-MiniLM-L6-v2
+EMBEDDING_BATCH_SIZE = 256  # Chunks per encode batch; lower if GPU memory is tight
 
 # LLM Configuration (prioritize free/open-source options)
 LLM_CONFIG = {
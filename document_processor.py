@@ -1,10 +1,29 @@
 # document_processor.py - Simple document processing
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from bs4 import BeautifulSoup
-from typing import List, Dict
+from typing import List, Dict, Optional
 from config import RAW_FILINGS_DIR, PROCESSED_DATA_DIR, CHUNK_SIZE
-from utils import clean_text, save_json, logger
+from utils import clean_text, save_json, logger, WORD_BLOCK_PATTERN
+
+# selectolax (C-backed) is much faster on multi-MB filings; fall back to bs4 + lxml
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# Common 10-K section headings, combined so the text is scanned once.
+# The MD&A gap is a lookahead: the match ends at 'management', so it cannot swallow
+# headings between there and 'discussion' (finditer matches never overlap)
+SECTION_HEADING_RE = re.compile(
+    r'(?P<business>item\s+1[\.\s]*business)'
+    r'|(?P<risk_factors>item\s+1a[\.\s]*risk\s+factors)'
+    r'|(?P<financial_performance>item\s+7[\.\s]*management(?=.*?discussion))'
+    r'|(?P<financial_statements>item\s+8[\.\s]*financial\s+statements)',
+    re.IGNORECASE
+)
 
 class DocumentProcessor:
     def __init__(self):
@@ -16,14 +35,24 @@ class DocumentProcessor:
             with open(filepath, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Remove script and style elements
-            for script in soup(["script", "style"]):
-                script.decompose()
+            if HTMLParser is not None:
+                tree = HTMLParser(content)
+                
+                # Remove script and style elements
+                for node in tree.css('script, style'):
+                    node.decompose()
+                
+                text = tree.text(separator=' ')
+            else:
+                soup = BeautifulSoup(content, 'lxml')
+                
+                # Remove script and style elements
+                for script in soup(["script", "style"]):
+                    script.decompose()
+                
+                text = soup.get_text()
             
-            # Get text and clean it
-            text = soup.get_text()
+            # Clean the extracted text
             text = clean_text(text)
             
             return text
@@ -34,15 +63,14 @@ class DocumentProcessor:
     
     def simple_chunk_text(self, text: str, max_words: int = CHUNK_SIZE) -> List[str]:
         """Simple word-based chunking."""
-        words = text.split()
+        # Each match is one chunk of up to max_words words, sliced from the original text
         chunks = []
         
-        for i in range(0, len(words), max_words):
-            chunk_words = words[i:i + max_words]
-            chunk = ' '.join(chunk_words)
+        for match in re.finditer(WORD_BLOCK_PATTERN % (max_words - 1), text):
+            chunk = match.group()
             
             # Only keep substantial chunks
-            if len(chunk.strip()) > 100:
+            if len(chunk) > 100:
                 chunks.append(chunk)
         
         return chunks
@@ -51,22 +79,15 @@ class DocumentProcessor:
         """Extract key sections from 10-K filing."""
         sections = {}
         
-        # Common 10-K section patterns
-        section_patterns = {
-            'business': r'item\s+1[\.\s]*business',
-            'risk_factors': r'item\s+1a[\.\s]*risk\s+factors',
-            'financial_performance': r'item\s+7[\.\s]*management.*discussion',
-            'financial_statements': r'item\s+8[\.\s]*financial\s+statements'
-        }
+        # First occurrence of each section heading, found in a single pass
+        section_starts = {}
+        for match in SECTION_HEADING_RE.finditer(text):
+            section_starts.setdefault(match.lastgroup, match.start())
         
-        for section_name, pattern in section_patterns.items():
-            # Find section start
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                start_pos = match.start()
-                # Get next ~5000 chars as a reasonable section size
-                section_text = text[start_pos:start_pos + 5000]
-                sections[section_name] = clean_text(section_text)
+        # Get next ~5000 chars as a reasonable section size - not cut at the next heading,
+        # since the first hits are usually table-of-contents lines right next to each other
+        for section_name, start_pos in section_starts.items():
+            sections[section_name] = clean_text(text[start_pos:start_pos + 5000])
         
         # If no sections found, just use the full text
         if not sections:
@@ -103,7 +124,9 @@ class DocumentProcessor:
                     'year': year,
                     'section': section_name,
                     'chunk_id': f"{company}_{year}_{section_name}_{i}",
-                    'source_file': filename
+                    'source_file': filename,
+                    'text_preview': chunk[:200],
+                    'source_key': f"{company}|{year}|{section_name}"
                 })
         
         doc_info = {
@@ -128,8 +151,12 @@ class DocumentProcessor:
         processed_docs = []
         total_chunks = 0
         
-        for filepath in sorted(html_files):
-            doc_info = self.process_filing(filepath)
+        # HTML parsing is CPU-bound and each filing is independent - fan out across cores
+        max_workers = min(len(html_files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            doc_infos = list(executor.map(process_filing_worker, sorted(html_files)))
+        
+        for doc_info in doc_infos:
             if doc_info:
                 processed_docs.append(doc_info)
                 total_chunks += doc_info['total_chunks']
@@ -141,6 +168,10 @@ class DocumentProcessor:
         logger.info(f"✓ Processed {len(processed_docs)} documents with {total_chunks} total chunks")
         return processed_docs
 
+def process_filing_worker(filepath: Path) -> Optional[Dict]:
+    """Process a single filing in a worker process (module-level so it pickles)."""
+    return DocumentProcessor().process_filing(filepath)
+
 def main():
     """Main function to process all filings."""
     print("Processing documents...")
@@ -1,8 +1,7 @@
 # main.py - Main CLI interface for the Financial RAG System
 import sys
-import json
 from agent_system import SimpleFinancialAgent
-from utils import logger
+from utils import logger, to_json_string
 
 def main():
     """Main CLI interface."""
@@ -29,7 +28,7 @@ def main():
         result = agent.answer_query(query)
         
         # Output formatted JSON result
-        print(json.dumps(result, indent=2, ensure_ascii=False))
+        print(to_json_string(result))
         
     except Exception as e:
         error_result = {
@@ -40,7 +39,7 @@ def main():
             "sub_queries": [query],
             "sources": []
         }
-        print(json.dumps(error_result, indent=2))
+        print(to_json_string(error_result))
         logger.error(f"Error processing query '{query}': {e}")
 
 if __name__ == "__main__":
@@ -1,20 +1,135 @@
 # rag_pipeline.py - Simple RAG pipeline with embeddings
+import atexit
+import hashlib
 import json
-import pickle
+import math
+import os
+import re
+import threading
 import numpy as np
+import torch
+from collections import OrderedDict
 from pathlib import Path
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict, Any, Optional
-from config import RAW_FILINGS_DIR, PROCESSED_DATA_DIR, VECTOR_STORE_DIR, EMBEDDING_MODEL, TOP_K_RETRIEVAL
-from utils import logger, load_json, save_json
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+from config import (RAW_FILINGS_DIR, PROCESSED_DATA_DIR, VECTOR_STORE_DIR, EMBEDDING_MODEL,
+                    EMBEDDING_DIMENSION, EMBEDDING_BATCH_SIZE, TOP_K_RETRIEVAL, QUERY_CACHE_SIZE,
+                    QUERY_CACHE_FLUSH_EVERY)
+from utils import logger, load_json, save_json, iter_filings, WORD_BLOCK_PATTERN
+
+# FAISS is optional - fall back to a plain numpy inner product if unavailable
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Reading with IO_FLAG_MMAP_IFC (faiss >= 1.11) maps the index's codes from the file instead of
+# copying them into the heap, so processes loading the same index share its pages
+FAISS_MMAP_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+
+# Embeddings are unit-normalized, so fp16 storage loses no meaningful ranking precision
+EMBEDDING_STORE_DTYPE = np.float16
+
+# Rows of the embedding matrix scored per block in the numpy fallback (~L2-sized)
+SEARCH_BLOCK_BYTES = 256 * 1024
+
+def _top_k(scores: np.ndarray, top_k: int):
+    """Return (scores, indices) of the top_k highest scores in each row, best first.
+    
+    Uses an O(N) partial selection followed by a sort of only the k winners,
+    rather than sorting every score.
+    """
+    k = min(top_k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+def _blocked_top_k(queries: np.ndarray, embeddings: np.ndarray, top_k: int,
+                   block_bytes: int = SEARCH_BLOCK_BYTES):
+    """Top-k inner products of each query against the embeddings, block by block.
+    
+    Each block of embedding rows stays cache-resident while the whole query batch
+    is scored against it, and is only upcast from float16 one block at a time.
+    Per-block winners are merged into a running top-k.
+    """
+    num_queries = queries.shape[0]
+    block_rows = max(1, block_bytes // (embeddings.shape[1] * embeddings.itemsize))
+    best_scores = np.empty((num_queries, 0), dtype=np.float32)
+    best_indices = np.empty((num_queries, 0), dtype=np.int64)
+    
+    for start in range(0, embeddings.shape[0], block_rows):
+        block = embeddings[start:start + block_rows]
+        scores, indices = _top_k(queries @ block.T, top_k)
+        
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_indices = np.concatenate([best_indices, indices + start], axis=1)
+        best_scores, order = _top_k(merged_scores, top_k)
+        best_indices = np.take_along_axis(merged_indices, order, axis=1)
+    
+    return best_scores, best_indices
+
+def _save_npy(path: Path, array: np.ndarray) -> None:
+    """Write an .npy file to a temp path and rename it into place."""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+def _query_key(query: str) -> str:
+    """Stable cache key for a query (normalized for case and surrounding whitespace)."""
+    normalized = f"{EMBEDDING_MODEL}|{query.strip().lower()}"
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+def _lru_get(cache: OrderedDict, key):
+    """Get a value from an LRU cache, marking it as most recently used."""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def _lru_put(cache: OrderedDict, key, value, max_size: int = QUERY_CACHE_SIZE) -> None:
+    """Insert into an LRU cache, evicting the least recently used entries."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
 
 class SimpleRAGPipeline:
+    _instance: Optional['SimpleRAGPipeline'] = None
+    _instance_lock = threading.Lock()
+    
+    @classmethod
+    def get_instance(cls) -> 'SimpleRAGPipeline':
+        """Return the process-wide pipeline, building (or loading) embeddings once."""
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = cls()
+                instance.build_embeddings()
+                cls._instance = instance
+            return cls._instance
+    
     def __init__(self):
         self.model = None
         self.embeddings = None
         self.chunks = []
-        self.embedding_cache_file = VECTOR_STORE_DIR / "embeddings.pkl"
+        self.chunk_to_emb_idx = None  # chunk index -> row in the (deduplicated) embedding matrix
+        self.emb_to_chunks = []  # embedding row -> chunk indices sharing that text
+        self.index = None
+        # Embeddings cache is split into plain files (no pickled model or torch state)
+        self.embedding_cache_file = VECTOR_STORE_DIR / "embeddings.npy"
+        self.chunk_map_file = VECTOR_STORE_DIR / "chunk_to_emb_idx.npy"
+        self.chunks_file = VECTOR_STORE_DIR / "chunks.json"
+        self.index_file = VECTOR_STORE_DIR / "faiss.index"
+        
+        # LRU caches: query hash -> embedding, (query hash, top_k) -> [(chunk index, score)]
+        self.query_cache_file = VECTOR_STORE_DIR / "qcache.npz"
+        self._qemb_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._result_cache: OrderedDict[Tuple[str, int], List[Tuple[int, float]]] = OrderedDict()
+        self._load_query_cache()
+        # Query embeddings added since the last write; the file is rewritten in batches, not per query
+        self._qcache_unsaved = 0
+        atexit.register(self._flush_query_cache)
         
     def load_processed_data(self) -> List[Dict]:
         """Load processed data from SEC-API or document processor."""
@@ -24,25 +139,31 @@ class SimpleRAGPipeline:
         
         if api_data_file.exists():
             logger.info("Loading SEC-API data...")
-            return self._convert_api_data_to_chunks(load_json(api_data_file))
+            return self._convert_api_data_to_chunks(iter_filings(api_data_file))
         elif processed_file.exists():
             logger.info("Loading processed document data...")
             data = load_json(processed_file)
             # Flatten chunks from all documents
             all_chunks = []
             for doc in data:
-                all_chunks.extend(doc['chunks'])
+                for chunk in doc['chunks']:
+                    # Files written before previews/source keys were precomputed lack them
+                    chunk.setdefault('text_preview', chunk['text'][:200])
+                    chunk.setdefault('source_key', f"{chunk['company']}|{chunk['year']}|{chunk['section']}")
+                    all_chunks.append(chunk)
             return all_chunks
         else:
             logger.error("No processed data found. Run data acquisition first.")
             return []
     
-    def _convert_api_data_to_chunks(self, api_data: List[Dict]) -> List[Dict]:
+    def _convert_api_data_to_chunks(self, api_data: Iterable[Dict]) -> List[Dict]:
         """Convert SEC-API data to chunks format."""
         chunks = []
         chunk_id = 0
+        num_filings = 0
         
         for filing in api_data:
+            num_filings += 1
             company = filing['company']
             year = filing['year']
             
@@ -60,43 +181,67 @@ class SimpleRAGPipeline:
                         'section': section_name,
                         'chunk_id': f"{company}_{year}_{section_name}_{i}",
                         'source_file': f"{company}_{year}_api_data",
-                        'filing_url': filing.get('filing_url', '')
+                        'filing_url': filing.get('filing_url', ''),
+                        'text_preview': chunk_text[:200],
+                        'source_key': f"{company}|{year}|{section_name}"
                     })
                     chunk_id += 1
         
-        logger.info(f"Created {len(chunks)} chunks from {len(api_data)} filings")
+        logger.info(f"Created {len(chunks)} chunks from {num_filings} filings")
         return chunks
     
     def _simple_chunk_text(self, text: str, max_words: int = 300, overlap: int = 50) -> List[str]:
         """Simple word-based chunking."""
-        words = text.split()
-        chunks = []
+        # Overlapping windows are whole numbers of blocks of gcd(max_words, step) words,
+        # so only block offsets are recorded and chunks are sliced from the original text
+        step = max_words - overlap
+        block_words = math.gcd(max_words, step)
+        starts, ends = [], []
+        for match in re.finditer(WORD_BLOCK_PATTERN % (block_words - 1), text):
+            start, end = match.span()
+            starts.append(start)
+            ends.append(end)
         
-        i = 0
-        while i < len(words):
-            chunk_words = words[i:i + max_words]
-            chunk = ' '.join(chunk_words)
+        chunks = []
+        window = max_words // block_words
+        for i in range(0, len(starts), step // block_words):
+            chunk = text[starts[i]:ends[min(i + window, len(ends)) - 1]]
             
             # Only keep substantial chunks
-            if len(chunk.strip()) > 100:
+            if len(chunk) > 100:
                 chunks.append(chunk)
-            
-            i += max_words - overlap
         
         return chunks
     
     def build_embeddings(self, force_rebuild: bool = False):
         """Build or load embeddings for all chunks."""
+        # Cached rankings refer to the previous embedding matrix
+        self._result_cache.clear()
+        
         # Check if cached embeddings exist
-        if self.embedding_cache_file.exists() and not force_rebuild:
+        cache_files = [self.embedding_cache_file, self.chunk_map_file, self.chunks_file]
+        if all(path.exists() for path in cache_files) and not force_rebuild:
             logger.info("Loading cached embeddings...")
-            with open(self.embedding_cache_file, 'rb') as f:
-                cached_data = pickle.load(f)
-                self.model = cached_data['model']
-                self.embeddings = cached_data['embeddings']
-                self.chunks = cached_data['chunks']
-            logger.info(f"Loaded {len(self.chunks)} chunks with embeddings")
-            return
+            self.chunks = load_json(self.chunks_file)
+            
+            # Chunks cached before source keys were precomputed need a rebuild
+            if self.chunks and 'source_key' in self.chunks[0]:
+                # Memory-map the matrix so start-up doesn't copy it into RSS; search only
+                # reads it in the numpy fallback (FAISS maps its own index file)
+                self.embeddings = np.load(self.embedding_cache_file, mmap_mode='r', allow_pickle=False)
+                chunk_to_emb_idx = np.load(self.chunk_map_file, allow_pickle=False)
+                
+                # The three files are written separately - a crash between writes leaves them mismatched
+                if (len(chunk_to_emb_idx) == len(self.chunks)
+                        and chunk_to_emb_idx.max(initial=-1) < len(self.embeddings)):
+                    self._set_chunk_mapping(chunk_to_emb_idx)
+                    self._load_or_build_index()
+                    logger.info(f"Loaded {len(self.chunks)} chunks with embeddings")
+                    return
+                
+                logger.warning("Cached embedding files don't match each other, rebuilding embeddings...")
+            else:
+                logger.warning("Cached chunks are out of date, rebuilding embeddings...")
         
         # Load data and build embeddings
         logger.info("Building embeddings from scratch...")
@@ -106,53 +251,211 @@ class SimpleRAGPipeline:
             logger.error("No chunks to process")
             return
         
-        # Initialize embedding model
-        logger.info(f"Loading embedding model: {EMBEDDING_MODEL}")
-        self.model = SentenceTransformer(EMBEDDING_MODEL)
-        
-        # Extract text for embedding
-        chunk_texts = [chunk['text'] for chunk in self.chunks]
+        # Extract text for embedding - boilerplate repeated across filings is embedded once
+        text_to_idx: Dict[str, int] = {}
+        chunk_texts = []
+        chunk_to_emb_idx = np.empty(len(self.chunks), dtype=np.int32)
+        for i, chunk in enumerate(self.chunks):
+            emb_idx = text_to_idx.get(chunk['text'])
+            if emb_idx is None:
+                emb_idx = text_to_idx[chunk['text']] = len(chunk_texts)
+                chunk_texts.append(chunk['text'])
+            chunk_to_emb_idx[i] = emb_idx
+        self._set_chunk_mapping(chunk_to_emb_idx)
         
         # Generate embeddings
-        logger.info(f"Generating embeddings for {len(chunk_texts)} chunks...")
-        self.embeddings = self.model.encode(
+        logger.info(f"Generating embeddings for {len(chunk_texts)} unique texts "
+                    f"({len(self.chunks)} chunks)...")
+        self.embeddings = self._load_model().encode(
             chunk_texts, 
+            batch_size=EMBEDDING_BATCH_SIZE,
             normalize_embeddings=True,
+            convert_to_numpy=True,
             show_progress_bar=True
         )
+        # Store as float16 - halves memory and the bytes streamed per search
+        self.embeddings = np.ascontiguousarray(self.embeddings, dtype=EMBEDDING_STORE_DTYPE)
+        self._build_index()
         
-        # Cache embeddings
-        cache_data = {
-            'model': self.model,
-            'embeddings': self.embeddings,
-            'chunks': self.chunks
-        }
-        
-        with open(self.embedding_cache_file, 'wb') as f:
-            pickle.dump(cache_data, f)
+        # Cache embeddings - replaced via rename, since other processes may have the old files mapped
+        _save_npy(self.embedding_cache_file, self.embeddings)
+        _save_npy(self.chunk_map_file, self.chunk_to_emb_idx)
+        save_json(self.chunks, self.chunks_file, indent=False)
         
         logger.info(f"Cached embeddings for {len(self.chunks)} chunks")
     
+    def _load_model(self) -> SentenceTransformer:
+        """Load the embedding model on first use."""
+        if self.model is None:
+            logger.info(f"Loading embedding model: {EMBEDDING_MODEL}")
+            self.model = SentenceTransformer(EMBEDDING_MODEL)
+            
+            if torch.cuda.is_available():
+                # fp16 on GPU roughly doubles encode throughput
+                self.model = self.model.to('cuda').half()
+            else:
+                torch.set_num_threads(os.cpu_count() or 1)
+        return self.model
+    
+    def _set_chunk_mapping(self, chunk_to_emb_idx: np.ndarray):
+        """Set the chunk -> embedding row mapping and its inverse."""
+        self.chunk_to_emb_idx = np.asarray(chunk_to_emb_idx, dtype=np.int32)
+        self.emb_to_chunks = [[] for _ in range(int(self.chunk_to_emb_idx.max(initial=-1)) + 1)]
+        for chunk_idx, emb_idx in enumerate(self.chunk_to_emb_idx):
+            self.emb_to_chunks[emb_idx].append(chunk_idx)
+    
+    def _build_index(self):
+        """Build an fp16 inner-product FAISS index over the normalized embeddings."""
+        if faiss is None:
+            return
+        
+        self.index = faiss.IndexScalarQuantizer(
+            EMBEDDING_DIMENSION,
+            faiss.ScalarQuantizer.QT_fp16,
+            faiss.METRIC_INNER_PRODUCT
+        )
+        self.index.add(self.embeddings.astype(np.float32))
+        
+        # Write then rename, so processes that have the old file mapped keep a valid copy
+        tmp_file = self.index_file.with_suffix('.index.tmp')
+        faiss.write_index(self.index, str(tmp_file))
+        os.replace(tmp_file, self.index_file)
+    
+    def _load_or_build_index(self):
+        """Load the persisted FAISS index, rebuilding it if missing or stale."""
+        if faiss is None:
+            return
+        
+        if self.index_file.exists():
+            self.index = faiss.read_index(str(self.index_file), FAISS_MMAP_FLAG)
+            if self.index.ntotal == len(self.embeddings):
+                return
+            logger.warning("FAISS index is out of date, rebuilding...")
+        
+        self._build_index()
+    
     def search(self, query: str, top_k: int = TOP_K_RETRIEVAL) -> List[Dict[str, Any]]:
         """Search for relevant chunks using cosine similarity."""
-        if self.model is None or self.embeddings is None:
+        return self._to_results(self.search_ids(query, top_k))
+    
+    def batch_search(self, queries: List[str], top_k: int = TOP_K_RETRIEVAL) -> List[List[Dict[str, Any]]]:
+        """Search for several queries at once with a single encode and matmul."""
+        return [self._to_results(hits) for hits in self.batch_search_ids(queries, top_k)]
+    
+    def search_ids(self, query: str, top_k: int = TOP_K_RETRIEVAL) -> List[Tuple[int, float]]:
+        """Like search(), but return (chunk index, score) pairs instead of chunk copies."""
+        return self.batch_search_ids([query], top_k)[0]
+    
+    def batch_search_ids(self, queries: List[str], top_k: int = TOP_K_RETRIEVAL) -> List[List[Tuple[int, float]]]:
+        """Like batch_search(), but return (chunk index, score) pairs per query."""
+        if self.embeddings is None:
             logger.error("Embeddings not built. Call build_embeddings() first.")
+            return [[] for _ in queries]
+        
+        if not queries:
             return []
         
-        # Generate query embedding
-        query_embedding = self.model.encode([query], normalize_embeddings=True)
+        # Repeated queries skip both the encode and the matmul
+        keys = [_query_key(query) for query in queries]
+        ranked = [_lru_get(self._result_cache, (key, top_k)) for key in keys]
+        misses = [i for i, hit in enumerate(ranked) if hit is None]
         
-        # Calculate similarities
-        similarities = cosine_similarity(query_embedding, self.embeddings)[0]
+        if misses:
+            # Embeddings are normalized, so inner product == cosine similarity
+            query_embeddings = self._encode_queries(
+                [queries[i] for i in misses],
+                [keys[i] for i in misses]
+            )
+            
+            if self.index is not None:
+                scores, indices = self.index.search(query_embeddings, top_k)
+            else:
+                # Cache-blocked (S, N) scoring, top-k per row
+                scores, indices = _blocked_top_k(query_embeddings, self.embeddings, top_k)
+            
+            for row, i in enumerate(misses):
+                ranked[i] = self._expand_to_chunks(indices[row], scores[row], top_k)
+                _lru_put(self._result_cache, (keys[i], top_k), ranked[i])
+        
+        return ranked
+    
+    def _encode_queries(self, queries: List[str], keys: List[str]) -> np.ndarray:
+        """Encode queries, reusing cached embeddings and batch-encoding the rest."""
+        embeddings = [_lru_get(self._qemb_cache, key) for key in keys]
+        # Uncached query key -> positions in the batch, so repeats are encoded once
+        missing: Dict[str, List[int]] = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(keys[i], []).append(i)
+        
+        if missing:
+            # Encode all uncached queries in one forward pass
+            encoded = self._load_model().encode(
+                [queries[positions[0]] for positions in missing.values()],
+                normalize_embeddings=True
+            )
+            for (key, positions), embedding in zip(missing.items(), np.asarray(encoded, dtype=np.float32)):
+                for i in positions:
+                    embeddings[i] = embedding
+                _lru_put(self._qemb_cache, key, embedding)
+            
+            self._qcache_unsaved += len(missing)
+            if self._qcache_unsaved >= QUERY_CACHE_FLUSH_EVERY:
+                self._flush_query_cache()
+        
+        return np.ascontiguousarray(np.stack(embeddings), dtype=np.float32)
+    
+    def _load_query_cache(self):
+        """Load persisted query embeddings from disk."""
+        if not self.query_cache_file.exists():
+            return
         
-        # Get top-k indices
-        top_indices = similarities.argsort()[-top_k:][::-1]
+        try:
+            with np.load(self.query_cache_file) as data:
+                for key, embedding in zip(data['keys'], data['embeddings']):
+                    _lru_put(self._qemb_cache, str(key), embedding)
+            logger.info(f"Loaded {len(self._qemb_cache)} cached query embeddings")
+        except Exception as e:
+            logger.warning(f"Failed to load query cache from {self.query_cache_file}: {e}")
+    
+    def _flush_query_cache(self):
+        """Persist query embeddings, if any were added, so repeat queries skip encoding across runs."""
+        if not self._qcache_unsaved:
+            return
         
-        # Return results with metadata
+        # Per-process temp name + rename, so concurrent workers never write into the same file
+        tmp_file = self.query_cache_file.with_name(f"{self.query_cache_file.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(
+                    f,
+                    keys=np.array(list(self._qemb_cache.keys())),
+                    embeddings=np.stack(list(self._qemb_cache.values()))
+                )
+            os.replace(tmp_file, self.query_cache_file)
+            self._qcache_unsaved = 0
+        except Exception as e:
+            logger.warning(f"Failed to save query cache to {self.query_cache_file}: {e}")
+    
+    def _expand_to_chunks(self, indices, scores, top_k: int) -> List[Tuple[int, float]]:
+        """Map ranked embedding rows back to (chunk index, score), keeping the first top_k."""
+        hits = []
+        for emb_idx, score in zip(indices, scores):
+            if emb_idx < 0:  # FAISS pads with -1 when top_k > ntotal
+                continue
+            for chunk_idx in self.emb_to_chunks[emb_idx]:
+                hits.append((chunk_idx, float(score)))
+            if len(hits) >= top_k:
+                break
+        
+        return hits[:top_k]
+    
+    def _to_results(self, hits: List[Tuple[int, float]]) -> List[Dict[str, Any]]:
+        """Attach similarity scores to copies of the matching chunks."""
         results = []
-        for idx in top_indices:
+        for idx, score in hits:
             chunk = self.chunks[idx].copy()
-            chunk['similarity_score'] = float(similarities[idx])
+            chunk['similarity_score'] = score
             results.append(chunk)
         
         return results
@@ -1,13 +1,26 @@
-# sec_api_downloader.py - Complete SEC-API.io integration for reliable filing extraction
-import requests
-import time
+# sec_downloader.py - Complete SEC-API.io integration for reliable filing extraction
+import aiohttp
+import asyncio
+from functools import partial
 import os
-import json
+import random
+import shutil
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Optional, Any
-from config import COMPANIES, YEARS, RAW_FILINGS_DIR
-from utils import logger, save_json
+from config import (COMPANIES, YEARS, RAW_FILINGS_DIR, SEC_API_MAX_CONCURRENCY,
+                    CACHE_ENABLED, FILING_URL_CACHE_TTL, SECTION_CACHE_TTL)
+from utils import logger, save_json, parse_json, to_json_string
+
+
+# HTTP statuses worth retrying (rate limited / transient upstream failure)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 10.0) -> float:
+    """Exponential backoff with full jitter, so concurrent retries don't move in lockstep."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
 
 
 class SECAPIDownloader:
@@ -22,15 +35,89 @@ class SECAPIDownloader:
 
         self.query_url = "https://api.sec-api.io"
         self.extractor_url = "https://api.sec-api.io/extractor"
-        self.session = requests.Session()
-        self.session.headers.update({'Authorization': self.api_key})
 
-        # Cache for filing URLs to avoid duplicate API calls
-        self.filing_cache = {}
+        # Created in __aenter__ - aiohttp sessions must be bound to a running loop
+        self.session: Optional[aiohttp.ClientSession] = None
+
+        # Caps in-flight API requests - concurrency, not sleeps, controls pacing
+        self._sem = asyncio.Semaphore(SEC_API_MAX_CONCURRENCY)
+
+        # Cache for filing URLs and extracted sections to avoid duplicate (billed) API
+        # calls, persisted across runs: {'urls' | 'sections': {key: {value, fetched_at}}}
+        self.cache_path = RAW_FILINGS_DIR / "filing_cache.json"
+        self.filing_cache = self._load_cache()
+        # Set by _cache_put; the cache is written once, in __aexit__, rather than per put
+        self._cache_dirty = False
+
+    async def __aenter__(self) -> 'SECAPIDownloader':
+        self.session = aiohttp.ClientSession(
+            headers={'Authorization': self.api_key},
+            json_serialize=partial(to_json_string, indent=False),
+            # Pool sized to the concurrency cap so every in-flight request reuses a
+            # kept-alive TLS connection; idle connections outlive backoff waits
+            connector=aiohttp.TCPConnector(
+                limit=SEC_API_MAX_CONCURRENCY,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._cache_dirty:
+            # Off the event loop - the cache holds full section bodies and can be large
+            await asyncio.to_thread(self._save_cache)
+            self._cache_dirty = False
+        await self.session.close()
+        self.session = None
+
+    def _require_session(self) -> None:
+        """Fail loudly when used outside the async context, rather than deep in a broad except."""
+        if self.session is None:
+            raise RuntimeError(
+                "SECAPIDownloader has no HTTP session - use it as "
+                "'async with SECAPIDownloader() as downloader:' and await its methods"
+            )
+
+    def _load_cache(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Load the on-disk cache, starting empty if it is disabled or unreadable."""
+        cache = {'urls': {}, 'sections': {}}
+        if CACHE_ENABLED and self.cache_path.exists():
+            try:
+                cache.update(parse_json(self.cache_path.read_bytes()))
+                logger.info("Loaded filing cache from %s", self.cache_path)
+            except Exception as e:
+                logger.warning("Ignoring unreadable filing cache %s: %s", self.cache_path, e)
+        return cache
+
+    def _cache_get(self, kind: str, key: str, ttl: float) -> Optional[str]:
+        """Return a cached value if present and younger than ttl seconds."""
+        entry = self.filing_cache[kind].get(key)
+        if entry and time.time() - entry['fetched_at'] < ttl:
+            return entry['value']
+        return None
+
+    def _cache_put(self, kind: str, key: str, value: str) -> None:
+        """Store a value; it reaches disk when the downloader context exits."""
+        self.filing_cache[kind][key] = {'value': value, 'fetched_at': time.time()}
+        if CACHE_ENABLED:
+            self._cache_dirty = True
 
-    def search_filings(self, company_cik: str, form_type: str = "10-K",
+    def _save_cache(self) -> None:
+        """Atomically write the cache (tmp file + rename) so a crash can't corrupt it."""
+        tmp_path = self.cache_path.with_suffix('.json.tmp')
+        try:
+            tmp_path.write_text(to_json_string(self.filing_cache, indent=False), encoding='utf-8')
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.error("Failed to save filing cache to %s: %s", self.cache_path, e)
+
+    async def search_filings(self, company_cik: str, form_type: str = "10-K",
                        year: Optional[int] = None, limit: int = 10) -> List[Dict]:
         """Search for filings using SEC-API Query API."""
+        self._require_session()
+
         # Construct search query
         query_parts = [
             f'cik:{company_cik}',
@@ -53,57 +140,57 @@ class SECAPIDownloader:
         }
 
         try:
-            logger.info(f"Searching filings: {query_string}")
-            response = self.session.post(self.query_url, json=payload, timeout=30)
-            response.raise_for_status()
+            logger.info("Searching filings: %s", query_string)
+            async with self._sem, self.session.post(
+                    self.query_url, json=payload, timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                response.raise_for_status()
+                data = parse_json(await response.read())
 
-            data = response.json()
             filings = data.get('filings', [])
 
-            logger.info(f"Found {len(filings)} filings for CIK {company_cik} in {year}")
+            logger.info("Found %s filings for CIK %s in %s", len(filings), company_cik, year)
             return filings
 
         except Exception as e:
-            logger.error(f"Error searching filings for CIK {company_cik}: {e}")
+            logger.error("Error searching filings for CIK %s: %s", company_cik, e)
             return []
 
-    def get_filing_url(self, company: str, year: int) -> Optional[str]:
+    async def get_filing_url(self, company: str, year: int) -> Optional[str]:
         """Get the most recent 10-K filing URL for a company and year."""
         cache_key = f"{company}_{year}"
 
-        if cache_key in self.filing_cache:
-            return self.filing_cache[cache_key]
+        cached_url = self._cache_get('urls', cache_key, FILING_URL_CACHE_TTL)
+        if cached_url:
+            return cached_url
 
         company_cik = COMPANIES[company]
-        filings = self.search_filings(company_cik, "10-K", year, 5)
+        filings = await self.search_filings(company_cik, "10-K", year, 5)
 
         # Find the best matching filing
         for filing in filings:
-            filing_year = datetime.fromisoformat(
-                filing['filedAt'].replace('Z', '+00:00')
-            ).year
+            # Dates are ISO-8601 ('YYYY-...'), so the year is the first four characters
+            filing_year = int(filing['filedAt'][:4])
 
             # For fiscal year filings, check both filing year and period year
-            period_year = None
-            if filing.get('periodOfReport'):
-                period_year = datetime.fromisoformat(
-                    filing['periodOfReport']
-                ).year
+            period_year = int(filing['periodOfReport'][:4]) if filing.get('periodOfReport') else None
 
             # Match by either filing year or period year
             if filing_year == year or period_year == year:
                 url = filing.get('linkToFilingDetails')
                 if url:
-                    self.filing_cache[cache_key] = url
-                    logger.info(f"Found {company} {year} filing: {url}")
+                    self._cache_put('urls', cache_key, url)
+                    logger.info("Found %s %s filing: %s", company, year, url)
                     return url
 
-        logger.warning(f"No {year} 10-K filing found for {company}")
+        logger.warning("No %s 10-K filing found for %s", year, company)
         return None
 
-    def extract_section(self, filing_url: str, item: str,
+    async def extract_section(self, filing_url: str, item: str,
                         return_type: str = 'text') -> Optional[str]:
         """Extract a specific section from a filing using SEC-API Extractor."""
+        self._require_session()
+
         params = {
             'url': filing_url,
             'item': item,
@@ -111,52 +198,63 @@ class SECAPIDownloader:
             'token': self.api_key
         }
 
-        max_retries = 3
+        cache_key = f"{filing_url}|{item}|{return_type}"
+        cached_content = self._cache_get('sections', cache_key, SECTION_CACHE_TTL)
+        if cached_content:
+            return cached_content
+
+        max_retries = 6
         for attempt in range(max_retries):
             try:
-                response = self.session.get(
-                    self.extractor_url,
-                    params=params,
-                    timeout=60
-                )
-                response.raise_for_status()
+                async with self._sem, self.session.get(self.extractor_url, params=params) as response:
+                    response.raise_for_status()
+                    content = await response.text()
 
-                content = response.text
+                stripped = content.strip()
 
                 # Check for "processing" response
-                if content.strip().lower() == "processing":
+                if len(stripped) == 10 and stripped.lower() == "processing":
                     if attempt < max_retries - 1:
-                        logger.info(f"Processing... retrying in 1 second (attempt {attempt + 1})")
-                        time.sleep(1)
+                        delay = backoff_delay(attempt)
+                        logger.info("Processing... retrying in %.1f seconds (attempt %s)", delay, attempt + 1)
+                        await asyncio.sleep(delay)
                         continue
                     else:
-                        logger.warning(f"Section {item} still processing after {max_retries} attempts")
+                        logger.warning("Section %s still processing after %s attempts", item, max_retries)
                         return None
 
                 # Check for empty or error responses
-                if not content or len(content.strip()) < 10:
-                    logger.warning(f"Empty or minimal content for item {item}")
+                if len(stripped) < 10:
+                    logger.warning("Empty or minimal content for item %s", item)
                     return None
 
+                self._cache_put('sections', cache_key, content)
                 return content
 
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Request error extracting item {item}: {e}")
+            except aiohttp.ClientResponseError as e:
+                logger.error("Request error extracting item %s: %s", item, e)
+                if e.status in RETRYABLE_STATUSES and attempt < max_retries - 1:
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("Request error extracting item %s: %s", item, e)
                 if attempt < max_retries - 1:
-                    time.sleep(1)
+                    await asyncio.sleep(backoff_delay(attempt))
                     continue
                 return None
             except Exception as e:
-                logger.error(f"Unexpected error extracting item {item}: {e}")
+                logger.error("Unexpected error extracting item %s: %s", item, e)
                 return None
 
         return None
 
-    def download_company_data(self, company: str, year: int) -> Optional[Dict]:
+    async def download_company_data(self, company: str, year: int) -> Optional[Dict]:
         """Download key sections for a company and year."""
-        logger.info(f"Processing {company} {year}...")
+        self._require_session()
+        logger.info("Processing %s %s...", company, year)
 
-        filing_url = self.get_filing_url(company, year)
+        filing_url = await self.get_filing_url(company, year)
         if not filing_url:
             return None
 
@@ -191,70 +289,78 @@ class SECAPIDownloader:
 
         sections_extracted = 0
 
-        for section_name, config in sections_config.items():
+        # The sections are independent - extract them concurrently
+        logger.info("  Extracting %s sections for %s %s...", len(sections_config), company, year)
+        contents = await asyncio.gather(
+            *(self.extract_section(filing_url, config['item'], 'text')
+              for config in sections_config.values()),
+            return_exceptions=True
+        )
+
+        for (section_name, config), content in zip(sections_config.items(), contents):
             item_code = config['item']
             description = config['description']
 
-            logger.info(f"  Extracting {description} (Item {item_code})...")
-
-            content = self.extract_section(filing_url, item_code, 'text')
+            if isinstance(content, Exception):
+                logger.error("     Error extracting %s (Item %s): %s", description, item_code, content)
+                content = None
 
             if content and len(content.strip()) > 100:  # Reasonable minimum length
                 # Limit content size but keep meaningful amount
                 max_chars = 50000  # 50K chars should be plenty for chunking
-                truncated_content = content[:max_chars]
+                truncated = len(content) > max_chars
+                # Only slice (and copy) when the content is actually too long
+                truncated_content = content[:max_chars] if truncated else content
 
                 company_data['sections'][section_name] = {
                     'item': item_code,
                     'description': description,
                     'content': truncated_content,
                     'full_length': len(content),
-                    'truncated': len(content) > max_chars
+                    'truncated': truncated
                 }
 
                 sections_extracted += 1
-                logger.info(f"     Extracted {len(content):,} characters")
+                logger.info("     Extracted %s (Item %s): %s characters", description, item_code, len(content))
 
-                if len(content) > max_chars:
-                    logger.info(f"    ℹ Truncated to {max_chars:,} characters")
+                if truncated:
+                    logger.info("    ℹ Truncated to %s characters", max_chars)
             else:
-                logger.warning(f"     Failed to extract {description}")
-
-            # Rate limiting to be respectful to the API
-            time.sleep(0.5)
+                logger.warning("     Failed to extract %s", description)
 
         if sections_extracted > 0:
-            logger.info(f"  Successfully extracted {sections_extracted}/{len(sections_config)} sections")
+            logger.info("  Successfully extracted %s/%s sections", sections_extracted, len(sections_config))
             return company_data
         else:
-            logger.error(f"  No sections successfully extracted for {company} {year}")
+            logger.error("  No sections successfully extracted for %s %s", company, year)
             return None
 
-    def download_all_data(self) -> List[Dict]:
+    async def download_all_data(self) -> List[Dict]:
         """Download data for all companies and years."""
+        self._require_session()
         logger.info("Starting comprehensive SEC filing download...")
-        logger.info(f"Target: {len(COMPANIES)} companies × {len(YEARS)} years = {len(COMPANIES) * len(YEARS)} filings")
+        logger.info("Target: %s companies × %s years = %s filings", len(COMPANIES), len(YEARS), len(COMPANIES) * len(YEARS))
 
         all_data = []
         successful_downloads = 0
         failed_downloads = []
 
-        for company in COMPANIES.keys():
-            for year in YEARS:
-                try:
-                    data = self.download_company_data(company, year)
-                    if data:
-                        all_data.append(data)
-                        successful_downloads += 1
-                    else:
-                        failed_downloads.append(f"{company} {year}")
-
-                except Exception as e:
-                    logger.error(f"Failed to process {company} {year}: {e}")
-                    failed_downloads.append(f"{company} {year}")
-
-                # Brief pause between companies to be respectful
-                time.sleep(1)
+        # Download every company/year concurrently - the work is almost all network wait
+        targets = [(company, year) for company in COMPANIES.keys() for year in YEARS]
+        results = await asyncio.gather(
+            *(self.download_company_data(company, year) for company, year in targets),
+            return_exceptions=True
+        )
+
+        for (company, year), data in zip(targets, results):
+            if isinstance(data, Exception):
+                logger.error("Failed to process %s %s: %s", company, year, data)
+                failed_downloads.append(f"{company} {year}")
+            elif data:
+                all_data.append(data)
+                successful_downloads += 1
+            else:
+                failed_downloads.append(f"{company} {year}")
 
         # Save all data
         if all_data:
@@ -262,35 +368,43 @@ class SECAPIDownloader:
             output_file = RAW_FILINGS_DIR / f"sec_api_data_{timestamp}.json"
             save_json(all_data, output_file)
 
-            # Also save the latest version
+            # Also expose it as the latest version - link rather than serialize twice
             latest_file = RAW_FILINGS_DIR / "sec_api_data_latest.json"
-            save_json(all_data, latest_file)
+            if output_file.exists():
+                latest_file.unlink(missing_ok=True)
+                try:
+                    os.link(output_file, latest_file)
+                except OSError:
+                    # Filesystem without hard link support
+                    shutil.copyfile(output_file, latest_file)
 
         # Print summary
-        logger.info(f"\n{'=' * 60}")
+        logger.info("\n%s", "=" * 60)
         logger.info("DOWNLOAD SUMMARY")
-        logger.info(f"{'=' * 60}")
-        logger.info(f"Successful downloads: {successful_downloads}")
-        logger.info(f"Failed downloads: {len(failed_downloads)}")
+        logger.info("=" * 60)
+        logger.info("Successful downloads: %s", successful_downloads)
+        logger.info("Failed downloads: %s", len(failed_downloads))
 
         if failed_downloads:
             logger.warning("Failed downloads:")
             for item in failed_downloads:
-                logger.warning(f"  - {item}")
+                logger.warning("  - %s", item)
 
         if all_data:
-            logger.info(f"\nData saved to: {RAW_FILINGS_DIR}")
+            logger.info("\nData saved to: %s", RAW_FILINGS_DIR)
 
             # Show what we extracted
             logger.info("\nExtracted data summary:")
             for item in all_data:
                 sections = list(item['sections'].keys())
-                logger.info(f"  {item['company']} {item['year']}: {len(sections)} sections")
+                logger.info("  %s %s: %s sections", item['company'], item['year'], len(sections))
 
         return all_data
 
-    def verify_api_access(self) -> bool:
+    async def verify_api_access(self) -> bool:
         """Verify API access by making a simple test query."""
+        self._require_session()
+
         test_payload = {
             "query": "ticker:AAPL AND formType:\"10-K\"",
             "from": "0",
@@ -298,10 +412,12 @@ class SECAPIDownloader:
         }
 
         try:
-            response = self.session.post(self.query_url, json=test_payload, timeout=10)
-            response.raise_for_status()
+            async with self._sem, self.session.post(
+                    self.query_url, json=test_payload, timeout=aiohttp.ClientTimeout(total=10)
+            ) as response:
+                response.raise_for_status()
+                data = parse_json(await response.read())
 
-            data = response.json()
             if 'filings' in data and isinstance(data['filings'], list):
                 logger.info(" SEC-API access verified successfully")
                 return True
@@ -310,30 +426,29 @@ class SECAPIDownloader:
                 return False
 
         except Exception as e:
-            logger.error(f" SEC-API access verification failed: {e}")
+            logger.error(" SEC-API access verification failed: %s", e)
             return False
 
 
-def main():
+async def main():
     """Main function to run the downloader."""
     print("SEC Filing Downloader")
     print("=" * 50)
 
     try:
         # Initialize downloader
-        downloader = SECAPIDownloader()
-
-        # Verify API access
-        if not downloader.verify_api_access():
-            print("\nFailed to verify API access. Please check:")
-            print("1. Your SEC_API_KEY environment variable is set")
-            print("2. Your API key is valid and has quota remaining")
-            print("3. Your internet connection is working")
-            return
-
-        # Download all data
-        print("\nStarting download process...")
-        data = downloader.download_all_data()
+        async with SECAPIDownloader() as downloader:
+            # Verify API access
+            if not await downloader.verify_api_access():
+                print("\nFailed to verify API access. Please check:")
+                print("1. Your SEC_API_KEY environment variable is set")
+                print("2. Your API key is valid and has quota remaining")
+                print("3. Your internet connection is working")
+                return
+
+            # Download all data
+            print("\nStarting download process...")
+            data = await downloader.download_all_data()
 
         if data:
             print(f"\n SUCCESS: Downloaded data for {len(data)} company/year combinations")
@@ -354,8 +469,8 @@ def main():
 
     except Exception as e:
         print(f"\n Unexpected Error: {e}")
-        logger.error(f"Unexpected error in main: {e}")
+        logger.error("Unexpected error in main: %s", e)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
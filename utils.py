@@ -1,67 +1,126 @@
 # utils.py - Common utilities and helper functions
 import json
+import os
 import re
 import time
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Iterator, Optional
 from datetime import datetime
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('rag_system.log'),
-        logging.StreamHandler()
-    ]
-)
+# orjson is optional - it is several times faster than stdlib json on large chunk files
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson is optional - lets large filing dumps be iterated without loading them whole
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Setup logging - handlers run on a QueueListener thread so log writes never block the event loop
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_file_handler = logging.FileHandler('rag_system.log')
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(_log_formatter)
+
+log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(log_queue)
+_log_listener = QueueListener(log_queue, _file_handler, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(_queue_handler)
+
+def _hold_log_handlers() -> None:
+    # Forking while the listener thread is mid-write would leave the child's streams locked
+    _file_handler.acquire()
+    _stream_handler.acquire()
+
+def _release_log_handlers() -> None:
+    _stream_handler.release()
+    _file_handler.release()
+
+def _log_directly_in_child() -> None:
+    # A forked child gets a copy of the queue (with any undrained parent records) but no
+    # listener, and pool workers exit via os._exit - so write straight to the handlers there.
+    # logging has already re-initialised the handler locks in the child.
+    _root_logger.removeHandler(_queue_handler)
+    _root_logger.addHandler(_file_handler)
+    _root_logger.addHandler(_stream_handler)
+
+os.register_at_fork(before=_hold_log_handlers,
+                    after_in_parent=_release_log_handlers,
+                    after_in_child=_log_directly_in_child)
 
 logger = logging.getLogger(__name__)
 
+# Compiled once at import - clean_text / extract_financial_numbers run over every section
+# Any run of whitespace and/or characters outside the kept financial notation
+_CLEAN_RE = re.compile(r'[^\w\.\,\$\%\(\)\-\:]+')
+_FINANCIAL_PATTERNS = {
+    'currency': re.compile(r'\$\s*(\d+(?:,\d{3})*(?:\.\d+)?)\s*(million|billion|thousand)?', re.IGNORECASE),
+    'percentage': re.compile(r'(\d+(?:\.\d+)?)\s*%', re.IGNORECASE),
+    'revenue': re.compile(r'revenue\s+(?:of\s+)?\$?\s*(\d+(?:,\d{3})*(?:\.\d+)?)', re.IGNORECASE),
+    'margin': re.compile(r'margin\s+(?:of\s+)?(\d+(?:\.\d+)?)\s*%', re.IGNORECASE)
+}
+
+# Word-block pattern for the chunkers: up to N+1 consecutive words (runs of non-whitespace),
+# so chunk boundaries are found with one match per block rather than one per word
+WORD_BLOCK_PATTERN = r'\S+(?:\s+\S+){0,%d}'
+
 def clean_text(text: str) -> str:
     """Clean and normalize text from filings."""
     if not text:
         return ""
 
-    # Remove multiple whitespaces
-    text = re.sub(r'\s+', ' ', text)
-
-    # Remove special characters but keep financial notation
-    text = re.sub(r'[^\w\s\.\,\$\%\(\)\-\:]', ' ', text)
-
-    # Clean up extra spaces
-    text = re.sub(r'\s+', ' ', text).strip()
+    # Collapse whitespace and special characters (keeping financial notation)
+    # into single spaces in one pass
+    return _CLEAN_RE.sub(' ', text).strip()
 
-    return text
+def iter_financial_numbers(text: str, with_context: bool = True) -> Iterator[Dict[str, Any]]:
+    """Yield financial numbers and percentages found in text.
 
-def extract_financial_numbers(text: str) -> List[Dict[str, Any]]:
-    """Extract financial numbers and percentages from text."""
-    patterns = {
-        'currency': r'\$\s*(\d+(?:,\d{3})*(?:\.\d+)?)\s*(million|billion|thousand)?',
-        'percentage': r'(\d+(?:\.\d+)?)\s*%',
-        'revenue': r'revenue\s+(?:of\s+)?\$?\s*(\d+(?:,\d{3})*(?:\.\d+)?)',
-        'margin': r'margin\s+(?:of\s+)?(\d+(?:\.\d+)?)\s*%'
-    }
-
-    findings = []
-    for pattern_name, pattern in patterns.items():
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
-            findings.append({
+    Pass with_context=False to skip building the surrounding-text excerpt.
+    """
+    for pattern_name, pattern in _FINANCIAL_PATTERNS.items():
+        for match in pattern.finditer(text):
+            finding = {
                 'type': pattern_name,
                 'value': match.group(1),
-                'context': text[max(0, match.start()-50):match.end()+50],
                 'position': match.start()
-            })
+            }
+            if with_context:
+                finding['context'] = text[max(0, match.start()-50):match.end()+50]
+            yield finding
 
-    return findings
+def extract_financial_numbers(text: str) -> List[Dict[str, Any]]:
+    """Extract financial numbers and percentages from text."""
+    return list(iter_financial_numbers(text))
 
-def save_json(data: Any, filepath: Path) -> None:
-    """Save data as JSON file."""
+def save_json(data: Any, filepath: Path, indent: bool = True) -> None:
+    """Save data as JSON file (pass indent=False for files only read by code)."""
+    # Written beside the target and renamed over it, so readers never see a partial file
+    tmp_path = Path(filepath).with_name(Path(filepath).name + '.tmp')
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        if orjson is not None:
+            option = orjson.OPT_NON_STR_KEYS
+            if indent:
+                option |= orjson.OPT_INDENT_2
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(data, option=option))
+        else:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2 if indent else None, ensure_ascii=False)
+        os.replace(tmp_path, filepath)
         logger.info(f"Saved data to {filepath}")
     except Exception as e:
         logger.error(f"Failed to save JSON to {filepath}: {e}")
@@ -71,14 +130,41 @@ def load_json(filepath: Path) -> Optional[Any]:
     try:
         if not filepath.exists():
             return None
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        if orjson is not None:
+            data = orjson.loads(filepath.read_bytes())
+        else:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
         logger.info(f"Loaded data from {filepath}")
         return data
     except Exception as e:
         logger.error(f"Failed to load JSON from {filepath}: {e}")
         return None
 
+def iter_filings(filepath: Path) -> Iterator[Dict[str, Any]]:
+    """Yield the records of a top-level JSON array (e.g. sec_api_data_*.json) one at a time."""
+    if not filepath.exists():
+        return
+    if ijson is None:
+        yield from load_json(filepath) or []
+        return
+    with open(filepath, 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=True)
+    logger.info(f"Streamed data from {filepath}")
+
+def to_json_string(data: Any, indent: bool = True) -> str:
+    """Serialize data as JSON text (indented unless indent=False)."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else None
+        return orjson.dumps(data, option=option).decode('utf-8')
+    return json.dumps(data, indent=2 if indent else None, ensure_ascii=False)
+
+def parse_json(raw: bytes) -> Any:
+    """Parse JSON from raw bytes (e.g. an HTTP response body)."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 def rate_limit_sleep(delay: float = 0.1) -> None:
     """Sleep to respect rate limits."""
     time.sleep(delay)
@@ -128,9 +214,17 @@ class ProgressTracker:
         self.total = total
         self.current = 0
         self.description = description
+        self._last_print = 0.0
 
     def update(self, increment: int = 1) -> None:
         self.current += increment
+
+        # Redraw at most ~10 times per second, but always show the final count
+        now = time.monotonic()
+        if now - self._last_print < 0.1 and self.current < self.total:
+            return
+        self._last_print = now
+
         progress = (self.current / self.total) * 100
         print(f"\r{self.description}: {self.current}/{self.total} ({progress:.1f}%)", end="", flush=True)
 